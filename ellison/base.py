@@ -1,15 +1,17 @@
 from ellison import validators
 from copy import copy
 from pymongo.son_manipulator import SONManipulator
+from pymongo import ASCENDING
+from pymongo.cursor import Cursor
 import logging
-import inspect, functools
+import inspect, functools, itertools, weakref
 
 log = logging.getLogger('ellison')
 
 global _classes_registry
 _classes_registry = {}
 
-__all__ = ['ClassInjectorManipulator','Document','Builder','query','Repository','UnitOfWork','DataContext','DataContextInjector','lazy']
+__all__ = ['ClassInjectorManipulator','Document','Builder','query','Repository','UnitOfWork','DataContext','DataContextInjector','lazy','PartialDocumentException']
 
 class ClassInjectorManipulator(SONManipulator):
     
@@ -76,7 +78,14 @@ class DocumentMetaclass(type):
 
 
 class Document(dict):
-    '''Base class for database documents. Not that documents are expected to be read only.'''
+    '''
+    Base class for database documents. Not that documents are expected to be read only.
+    
+    Documents returned by a :func:`query` with ``fields`` are partial. Reading a field that was
+    not projected with ``[]`` or ``get`` loads the missing fields of the documents fetched by the
+    same cursor in one query. ``in``, ``keys()``, ``items()`` and iteration only see the fields
+    that are loaded; call :meth:`load` first if the whole document is needed.
+    '''
     __metaclass__ = DocumentMetaclass
 
     @classmethod
@@ -136,6 +145,41 @@ class Document(dict):
     def mongo_id(self):
         return self.get('_id',None)
 
+    def is_partial(self):
+        '''``True`` if the document was fetched with a projection and its other fields are not loaded yet.'''
+        return getattr(self,'__partial__',None) is not None
+
+    def loaded_fields(self):
+        '''
+        Names of the fields fetched whole by the projection or ``None`` if the document is complete.
+        A field fetched with a dotted projection (``a`` for ``a.x``) is not whole and is not listed.
+        '''
+        if self.is_partial():
+            return self.__partial__.fields
+        return None
+
+    def load(self):
+        '''
+        Fetch the fields left out by the projection. Fields already held by the document,
+        including the ones set locally, are kept. Does nothing if the document is complete.
+        '''
+        if self.is_partial():
+            self.__partial__.load()
+
+    def __missing__(self, key):
+        if self.is_partial() and key not in self.__partial__.fields:
+            self.load()
+            if self.is_partial():
+                raise PartialDocumentException('Cannot load "%s": the document is still partial after loading.' % key)
+            if dict.__contains__(self,key):
+                return dict.__getitem__(self,key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if self.is_partial() and key not in self and key not in self.__partial__.fields:
+            self.load()
+        return dict.get(self, key, default)
+
 class Builder(object):
     '''
     Base class for documents builders. It can ensure the structure of the document,
@@ -294,7 +338,7 @@ class Builder(object):
             
         return doc
 
-def query(index=None, one=False, sort=None, distinct=None):
+def query(index=None, one=False, sort=None, distinct=None, stream=False, group_by=None):
     '''
     A decorator that adds syntactic sugar to query methods in a :class:`Repository`.
     The following code::
@@ -314,7 +358,7 @@ def query(index=None, one=False, sort=None, distinct=None):
             return self.collection().find(query,fields=fields).sort('last_name')
 
     The ``fields`` parameter of the decorated method is optional. If it is provided, `_id` and `_cls` fields
-    are always returned.
+    are always returned and the documents are partial (see :class:`Document`).
     
     All of the following parameters are optional:
 
@@ -327,9 +371,28 @@ def query(index=None, one=False, sort=None, distinct=None):
         is the field to sort on and the second one is ordering (``sort=('name',ASCENDING)``). Otherwise
         a field name is expected.
     :param distinct: Does a ``collection.find(...).distinct(...)`` query. Needs a field name.
-
-    :return: The :class:`~pymongo.cursor.Cursor` instance.
+    :param stream: If ``True``, ``distinct`` values are not built into one list by the server (which
+        fails when it is over the document size limit) but read from a query sorted on the field and
+        yielded one by one as they arrive. Put an index on the field with ``index``, otherwise the server
+        sorts all matching documents in memory. The scan is only index-only if that index also covers the
+        query, i.e. the query filters on nothing but the field (otherwise use a compound ``index`` that
+        starts with the filtered fields). The field must hold scalar values: a list value raises
+        :class:`TypeError`, because the sorted scan cannot unwind it. ``sort`` and ``fields`` cannot be used.
+    :param group_by: Sorts the cursor on the given field (``sort`` becomes the secondary ordering) and
+        yields ``(key, documents)`` tuples, one for each value of the field. Documents missing
+        the field are grouped under ``None``. Put an index on the field with ``index``. The field must
+        hold scalar values: a list value raises :class:`TypeError`, because the server sorts lists by
+        their smallest element and the groups would not be contiguous.
+
+    :return: The :class:`~pymongo.cursor.Cursor` instance, or a generator if ``stream`` or ``group_by``
+        is used. With ``fields`` the cursor is a private subclass of :class:`~pymongo.cursor.Cursor`
+        that marks the documents it returns as partial.
     '''
+    assert not stream or distinct is not None, '"stream" needs a "distinct" field.'
+    assert not stream or sort is None, '"stream" sorts on the "distinct" field, "sort" cannot be used.'
+    assert distinct is None or group_by is None, '"distinct" and "group_by" cannot be combined.'
+    assert not one or (not stream and group_by is None), '"one" cannot be combined with "stream" or "group_by".'
+    
     def decorator(target):
         def wrapper(self, *args, **kwargs):
             query = target(self, *args, **kwargs)
@@ -343,17 +406,38 @@ def query(index=None, one=False, sort=None, distinct=None):
                 self.collection().ensure_index(index)
                 
             if kwargs.get('fields',None) is not None:
-                if '_cls' not in kwargs['fields']:
-                    kwargs['fields'].append('_cls')
-                    
-                fields = kwargs['fields']   
+                fields = list(kwargs['fields'])
+                if '_cls' not in fields:
+                    fields.append('_cls')
             else:
                 fields = None
             
+            if stream:
+                assert fields is None, '"stream" only fetches the "distinct" field, "fields" cannot be used.'
+                cursor = self.collection().find(query, fields={distinct : 1, '_id' : 0}).sort(distinct)
+                return _iter_distinct(cursor, distinct)
+            
+            if group_by is not None:
+                if fields is not None and group_by not in fields:
+                    fields = fields + [group_by]
+                order = [(group_by,ASCENDING)]
+                if isinstance(sort,tuple):
+                    order.append(sort)
+                elif sort is not None:
+                    order.append((sort,ASCENDING))
+                cursor = self.collection().find(query, fields=fields).sort(order)
+                if fields is not None:
+                    cursor = _partial_cursor(cursor, _PartialLoader(self.collection(), fields))
+                return _iter_groups(cursor, group_by)
+            
             if one:
                 cursor = self.collection().find_one(query, fields=fields)
+                if fields is not None and isinstance(cursor,Document):
+                    _PartialLoader(self.collection(), fields).add(cursor)
             else:
                 cursor = self.collection().find(query, fields=fields)
+                if fields is not None:
+                    cursor = _partial_cursor(cursor, _PartialLoader(self.collection(), fields))
                 
             if sort is not None:
                 if isinstance(sort,tuple):
@@ -370,6 +454,216 @@ def query(index=None, one=False, sort=None, distinct=None):
 
     return decorator
 
+class _PartialState(object):
+    '''Fields held by a partial document or subdocument and the batch that loads the rest.'''
+    
+    def __init__(self, batch, root, fields):
+        self.batch = batch
+        self.root = weakref.ref(root)
+        self.fields = fields
+        
+    def load(self):
+        root = self.root() if self.root is not None else None
+        if root is None:
+            raise PartialDocumentException('Cannot load missing fields: the document is detached from the query it was fetched with.')
+        self.batch.load(root)
+        
+    def __getstate__(self):
+        # a copied or unpickled document keeps knowing its fields but cannot load the rest
+        return {'fields' : self.fields}
+        
+    def __setstate__(self, state):
+        self.batch = None
+        self.root = None
+        self.fields = state['fields']
+
+class _PartialSubdocument(dict):
+    '''A subdocument truncated by a dotted projection, e.g. ``a`` when ``a.x`` is fetched.'''
+    is_partial = Document.__dict__['is_partial']
+    loaded_fields = Document.__dict__['loaded_fields']
+    load = Document.__dict__['load']
+    __missing__ = Document.__dict__['__missing__']
+    get = Document.__dict__['get']
+
+def _mark_partial(target, paths, batch, root):
+    fields = frozenset(p for p in paths if '.' not in p)
+    nested = {}
+    for p in paths:
+        if '.' in p:
+            head,rest = p.split('.',1)
+            if head not in fields:
+                nested.setdefault(head,[]).append(rest)
+    target.__partial__ = _PartialState(batch, root, fields)
+    for head,rest in nested.items():
+        value = dict.get(target,head)
+        if isinstance(value,list):
+            for idx,entry in enumerate(value):
+                if isinstance(entry,dict):
+                    if not isinstance(entry,(Document,_PartialSubdocument)):
+                        value[idx] = entry = _PartialSubdocument(entry)
+                    _mark_partial(entry, rest, batch, root)
+        elif isinstance(value,dict):
+            if not isinstance(value,(Document,_PartialSubdocument)):
+                value = _PartialSubdocument(value)
+                dict.__setitem__(target, head, value)
+            _mark_partial(value, rest, batch, root)
+
+def _unmark_partial(target):
+    target.__partial__ = None
+    for value in dict.values(target):
+        for entry in (value if isinstance(value,list) else [value]):
+            if getattr(entry,'__partial__',None) is not None:
+                _unmark_partial(entry)
+
+def _lines_up(held, loaded):
+    '''``True`` if ``loaded`` holds the same projected content as the partial value ``held``.'''
+    if isinstance(held,list):
+        return isinstance(loaded,list) and len(held) == len(loaded) and \
+            all(_lines_up(h,l) for h,l in zip(held,loaded))
+    if getattr(held,'__partial__',None) is not None:
+        return isinstance(loaded,dict) and \
+            all(k in loaded and _lines_up(dict.__getitem__(held,k),loaded[k]) for k in dict.keys(held))
+    return held == loaded
+
+def _fill_partial(target, source, fill=True):
+    '''
+    Copy to ``target`` the fields it does not hold yet, keeping the ones set locally.
+    A list of partial subdocuments is filled entry by entry, so it has to line up with
+    the loaded list; otherwise :class:`PartialDocumentException` is raised (with ``fill=False``
+    nothing is copied, the content is only checked).
+    '''
+    for k,v in source.items():
+        if not dict.__contains__(target,k):
+            if fill:
+                dict.__setitem__(target,k,v)
+            continue
+        current = dict.__getitem__(target,k)
+        if isinstance(current,list) and [e for e in current if getattr(e,'__partial__',None) is not None]:
+            if not _lines_up(current, v):
+                raise PartialDocumentException('Cannot load missing fields of "%s": the list was changed since it was fetched' % k)
+            pairs = zip(current,v)
+        else:
+            pairs = [(current,v)]
+        for held,loaded in pairs:
+            if isinstance(loaded,dict) and getattr(held,'__partial__',None) is not None:
+                _fill_partial(held, loaded, fill)
+
+class _PartialBatch(object):
+    '''
+    Partial documents fetched one after another by the same cursor. Reading a missing
+    field of one of them loads the missing fields of all of them with one query.
+    '''
+    
+    def __init__(self, loader):
+        self.loader = loader
+        self.docs = []
+        self.size = 0
+        
+    def add(self, doc):
+        self.docs.append(weakref.ref(doc))
+        self.size += 1
+        
+    def load(self, doc):
+        if not dict.__contains__(doc,'_id'):
+            raise PartialDocumentException('Cannot load missing fields of a document without "_id": %s' % dict(doc))
+        docs = [d for d in (ref() for ref in self.docs) if d is not None and d.is_partial()]
+        if not [d for d in docs if d is doc]:
+            docs.append(doc)
+        
+        by_id = {}
+        for d in docs:
+            if dict.__contains__(d,'_id'):
+                by_id.setdefault(dict.__getitem__(d,'_id'),[]).append(d)
+        spec = {'_id' : {'$in' : list(by_id.keys())}}
+        error = None
+        for source in self.loader.collection.find(spec, fields=self.loader.exclude):
+            for d in by_id.pop(source['_id'],()):
+                try:
+                    _fill_partial(d, source, fill=False)
+                except PartialDocumentException, e:
+                    by_id.setdefault(source['_id'],[]).append(d)
+                    if d is doc:
+                        error = e
+                    continue
+                _fill_partial(d, source)
+                _unmark_partial(d)
+        
+        # documents that were not found or could not be filled stay partial
+        self.docs = [weakref.ref(d) for found in by_id.values() for d in found]
+        if error is not None:
+            raise error
+        if doc.is_partial():
+            raise PartialDocumentException('Cannot load missing fields of %s: it is not in "%s" anymore' % \
+                (dict.__getitem__(doc,'_id'), self.loader.collection.name))
+
+class _PartialLoader(object):
+    '''Marks the documents fetched by one cursor with a projection as partial.'''
+    
+    batch_size = 1000
+    '''Maximum number of documents loaded with one query.'''
+    
+    def __init__(self, collection, fields):
+        self.collection = collection
+        self.fields = list(fields) + ['_id']
+        self.exclude = dict((f,0) for f in fields if '.' not in f and f != '_id') or None
+        self._batch = None
+        
+    def add(self, doc):
+        if self._batch is None or self._batch.size >= self.batch_size:
+            self._batch = _PartialBatch(self)
+        self._batch.add(doc)
+        _mark_partial(doc, self.fields, self._batch, doc)
+
+class _PartialCursor(Cursor):
+    '''A :class:`~pymongo.cursor.Cursor` that marks the documents it returns as partial.'''
+    
+    def next(self):
+        doc = Cursor.next(self)
+        if isinstance(doc,Document):
+            self._loader.add(doc)
+        return doc
+        
+    __next__ = next
+    
+    def clone(self):
+        return _partial_cursor(Cursor.clone(self), self._loader)
+
+def _partial_cursor(cursor, loader):
+    cursor.__class__ = _PartialCursor
+    cursor._loader = loader
+    return cursor
+
+_missing = object()
+
+def _get_field(doc, field):
+    for name in field.split('.'):
+        if not isinstance(doc,dict) or name not in doc:
+            return _missing
+        doc = doc[name]
+    return doc
+
+def _iter_distinct(cursor, field):
+    '''Yield distinct values of ``field`` from a ``cursor`` sorted on this field.'''
+    previous = _missing
+    for doc in cursor:
+        value = _get_field(doc, field)
+        if value is _missing or (previous is not _missing and value == previous):
+            continue
+        if isinstance(value,list):
+            raise TypeError('Cannot stream distinct values of "%s": it holds a list %s' % (field, value))
+        previous = value
+        yield value
+
+def _iter_groups(cursor, field):
+    '''Yield ``(key, documents)`` tuples from a ``cursor`` sorted on ``field``.'''
+    def key(doc):
+        value = _get_field(doc, field)
+        if isinstance(value,list):
+            raise TypeError('Cannot group by "%s": it holds a list %s' % (field, value))
+        return None if value is _missing else value
+    for value,docs in itertools.groupby(cursor, key):
+        yield value, list(docs)
+
 class Repository(object):
 
     def __init__(self,db):
@@ -390,12 +684,18 @@ class Repository(object):
             doc = obj.build()
         else:
             doc = obj
+            if isinstance(doc,Document):
+                # saving a partial document would drop the fields that were not fetched
+                doc.load()
         doc['_id'] = self.collection().save(doc,safe=True)
         doc = self.collection().database._fix_outgoing(doc,self.collection())
         return doc
         
     def update(self, document):
         assert '_id' in document, 'Trying to update a document without "_id"'
+        if isinstance(document,Document):
+            # saving a partial document would drop the fields that were not fetched
+            document.load()
         self.collection().save(document,safe=True)
 
     def foreach(self,fn, batch_size = 100):
@@ -421,6 +721,9 @@ class DataContext(object):
 class LazyLoadingException(Exception):
     pass
 
+class PartialDocumentException(Exception):
+    pass
+
 def lazy(method):
     @functools.wraps(method)
     def cache(self,*args,**kwargs):
@@ -0,0 +1,272 @@
+'''
+Opt-in profiling of the hot paths of ellison.
+
+When profiling is disabled nothing is instrumented: the hooks are installed by
+replacing methods on the profiled classes in :func:`enable` and the original
+methods are put back in :func:`disable`, so there is no cost in production.
+
+The following stages are measured:
+
+    * ``manipulator.incoming`` / ``manipulator.outgoing`` - :class:`~ellison.base.ClassInjectorManipulator`
+    * ``context.incoming`` / ``context.outgoing`` - :class:`~ellison.base.DataContextInjector`
+    * ``hydration`` - :class:`~ellison.base.Document` construction
+    * ``builder.validation`` / ``builder.build`` - :class:`~ellison.base.Builder` field validation and building
+    * ``database`` - round trips made by pymongo collections and cursors
+
+Documents and builders are aggregated by class name, database calls by the full
+name of the collection. Timings are inclusive: a stage that calls another stage
+includes its time (e.g. ``database`` includes incoming manipulators run by
+``save``). Recursive calls of the same stage are only counted once.
+
+Memory is measured as the growth of the peak resident set size of the process
+during the call (``ru_maxrss`` of :func:`resource.getrusage`, in kilobytes on
+Linux and bytes on Mac OS X). It shows which stages push the memory high-water
+mark up, not every allocation. It is ``None`` where :mod:`resource` is not
+available (Windows).
+
+Calls are added to the process-wide aggregate returned by :func:`stats` only
+while profiling is enabled with :func:`enable`; :func:`profile` blocks only
+record into their own :class:`Profile`.
+
+Example::
+
+    from ellison import profiling
+
+    with profiling.profile() as p:
+        list(repository.get_all())
+    p.dump()
+'''
+from ellison.base import ClassInjectorManipulator, DataContextInjector, Document, Builder
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from contextlib import contextmanager
+import functools
+import threading
+import time
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ['enable','disable','is_enabled','profile','stats','reset','dump','Profile','Stat']
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+_lock = threading.RLock()
+_local = threading.local()
+_installed = {}
+_active = 0
+_enabled = False
+_installed_hooks = False
+
+def _incoming_key(instance, args, result):
+    return args[0].__class__.__name__
+
+def _outgoing_key(instance, args, result):
+    return result.__class__.__name__
+
+def _class_key(instance, args, result):
+    return instance.__class__.__name__
+
+def _collection_key(instance, args, result):
+    return instance.full_name
+
+def _cursor_key(instance, args, result):
+    return instance.collection.full_name
+
+def _hooks():
+    hooks = [
+        (ClassInjectorManipulator, 'transform_incoming', 'manipulator.incoming', _incoming_key),
+        (ClassInjectorManipulator, 'transform_outgoing', 'manipulator.outgoing', _outgoing_key),
+        (DataContextInjector, 'transform_incoming', 'context.incoming', _incoming_key),
+        (DataContextInjector, 'transform_outgoing', 'context.outgoing', _outgoing_key),
+        (Document, '__init__', 'hydration', _class_key),
+        (Builder, '_validate_field', 'builder.validation', _class_key),
+        (Builder, 'build', 'builder.build', _class_key),
+    ]
+    for name in ('insert','update','remove','save','find_and_modify','distinct'):
+        hooks.append((Collection, name, 'database', _collection_key))
+    for name in ('_refresh','distinct','count'):
+        hooks.append((Cursor, name, 'database', _cursor_key))
+    return hooks
+
+class Stat(object):
+    '''Aggregated measurements of one stage for one key.'''
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.memory = None
+
+    def _add_memory(self, memory):
+        if memory is not None:
+            self.memory = (self.memory or 0) + memory
+
+    def add(self, elapsed, memory):
+        self.calls += 1
+        self.time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self._add_memory(memory)
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.time += other.time
+        self.max_time = max(self.max_time, other.max_time)
+        self._add_memory(other.memory)
+
+    def __repr__(self):
+        return '<Stat calls=%s time=%.6f max_time=%.6f memory=%s>' % \
+            (self.calls, self.time, self.max_time, self.memory)
+
+class Profile(object):
+    '''
+    A set of :class:`Stat` objects keyed by ``(stage, key)``.
+
+    ``memory`` is the growth of the peak resident set size of the process (see the
+    module documentation), or ``None`` if it cannot be measured.
+    '''
+
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, stage, key, elapsed, memory):
+        stat = self.stats.get((stage,key))
+        if stat is None:
+            stat = self.stats[(stage,key)] = Stat()
+        stat.add(elapsed, memory)
+
+    def by_stage(self):
+        '''Totals per stage, regardless of the key.'''
+        totals = {}
+        for (stage,key),stat in self.stats.items():
+            totals.setdefault(stage, Stat()).merge(stat)
+        return totals
+
+    def dump(self, stream=None):
+        '''Write a table of the aggregates sorted by total time to ``stream`` (``sys.stdout`` by default).'''
+        stream = stream or sys.stdout
+        stream.write('%-22s %-30s %10s %12s %12s %12s\n' % ('stage','key','calls','time','max','peak_rss'))
+        for (stage,key),stat in sorted(self.stats.items(), key=lambda item: -item[1].time):
+            memory = '-' if stat.memory is None else stat.memory
+            stream.write('%-22s %-30s %10d %12.6f %12.6f %12s\n' % \
+                (stage, key, stat.calls, stat.time, stat.max_time, memory))
+
+_global = Profile()
+
+def _peak_rss():
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+def _record(stage, key, elapsed, memory):
+    if _enabled:
+        with _lock:
+            _global.record(stage, key, elapsed, memory)
+    # profiles captured with profile() only see the calls of their own thread
+    for p in getattr(_local, 'profiles', ()):
+        p.record(stage, key, elapsed, memory)
+
+def _wrap(method, stage, key_fn):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(_local, 'depth', None)
+        if depth is None:
+            depth = _local.depth = {}
+        if depth.get(stage):
+            return method(self, *args, **kwargs)
+        depth[stage] = 1
+        peak = _peak_rss()
+        start = _timer()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            elapsed = _timer() - start
+            if peak is not None:
+                memory = _peak_rss() - peak
+            else:
+                memory = None
+            depth[stage] = 0
+        try:
+            key = key_fn(self, args, result)
+        except Exception:
+            key = None
+        _record(stage, key, elapsed, memory)
+        return result
+    return wrapper
+
+def _install():
+    global _installed_hooks
+    if _installed_hooks:
+        return
+    for klass,name,stage,key_fn in _hooks():
+        if name not in klass.__dict__:
+            continue
+        original = klass.__dict__[name]
+        _installed[(klass,name)] = original
+        setattr(klass, name, _wrap(original, stage, key_fn))
+    _installed_hooks = True
+
+def _uninstall():
+    global _installed_hooks
+    for (klass,name),original in _installed.items():
+        setattr(klass, name, original)
+    _installed.clear()
+    _installed_hooks = False
+
+def enable():
+    '''Install the profiling hooks until :func:`disable` is called.'''
+    global _enabled
+    with _lock:
+        _install()
+        _enabled = True
+
+def disable():
+    '''Remove the profiling hooks and restore the original methods. Collected aggregates are kept.'''
+    global _enabled
+    with _lock:
+        _enabled = False
+        if not _active:
+            _uninstall()
+
+def is_enabled():
+    return _enabled
+
+def stats():
+    '''Return the :class:`Profile` with everything collected since the last :func:`reset`.'''
+    return _global
+
+def reset():
+    global _global
+    with _lock:
+        _global = Profile()
+
+def dump(stream=None):
+    _global.dump(stream)
+
+@contextmanager
+def profile():
+    '''
+    Capture a :class:`Profile` of the enclosed block. Only calls made by the current
+    thread are captured. Hooks are installed for the duration of the block unless
+    profiling has already been enabled with :func:`enable`.
+    '''
+    global _active
+    p = Profile()
+    if not hasattr(_local, 'profiles'):
+        _local.profiles = []
+    with _lock:
+        _install()
+        _active += 1
+    _local.profiles.append(p)
+    try:
+        yield p
+    finally:
+        _local.profiles.remove(p)
+        with _lock:
+            _active -= 1
+            if not _enabled and not _active:
+                _uninstall()
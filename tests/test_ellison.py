@@ -1,8 +1,11 @@
 from ellison import *
+from ellison import profiling
 from pymongo import *
 import unittest
 from pymongo.son_manipulator import ObjectIdInjector
 from datetime import datetime
+import pickle
+import threading
 
 _db = Connection().test
 _data_context = DataContext()
@@ -50,6 +53,16 @@ class TestRepository(Repository):
 			'a' : a
 		}
 	
+	@query(index='c',distinct='c',stream=True)
+	def get_all_by_a_distinct_c_stream(self,a,fields=None):
+		return {
+			'a' : a
+		}
+
+	@query(group_by='a',sort='b')
+	def get_all_grouped_by_a(self,fields=None):
+		return {}
+
 	@query()
 	def get_wrong_1(self):
 		return None
@@ -129,6 +142,31 @@ class QueryDecoratorTest(unittest.TestCase):
 		self.assertEquals(3,len(objects))
 		self.assertEquals([0.5,25.1,42], objects)
 		
+	def test_distinct_stream(self):
+		objects = self.repository.get_all_by_a_distinct_c_stream('a')
+		self.assertFalse(isinstance(objects,list))
+		self.assertEquals([0.5,25.1,42], list(objects))
+		
+		self.repository.collection().insert({'a':'a','c':[1,2]})
+		self.assertRaises(TypeError, list, self.repository.get_all_by_a_distinct_c_stream('a'))
+		
+		self.assertRaises(AssertionError, query, stream=True)
+		self.assertRaises(AssertionError, query, distinct='c', group_by='a')
+		self.assertRaises(AssertionError, query, distinct='c', stream=True, sort='c')
+		self.assertRaises(AssertionError, self.repository.get_all_by_a_distinct_c_stream, 'a', fields=['c'])
+		
+	def test_group_by(self):
+		groups = list(self.repository.get_all_grouped_by_a())
+		self.assertEquals(['a','b','c'], [k for k,docs in groups])
+		self.assertEquals([1,1,1,2], [o['b'] for o in groups[0][1]])
+		self.assertEquals(3, len(groups[1][1]))
+		
+		groups = list(self.repository.get_all_grouped_by_a(fields=['b']))
+		self.assertEquals(['a','b','c'], [k for k,docs in groups])
+		
+		self.repository.collection().insert({'a':['d','e'],'b':1})
+		self.assertRaises(TypeError, list, self.repository.get_all_grouped_by_a())
+		
 	def test_wrong(self):
 		self.assertEquals(None,self.repository.get_wrong_1())
 		
@@ -176,6 +214,128 @@ class TestLazyLoading(unittest.TestCase):
         doc1 = _data_context.docs.get_one_by_a('a')
         doc2 = _data_context.docs.get_one_by_a('a')
         self.assertNotEquals(doc1.hash(),doc2.hash())
+
+class TestPartialDocuments(unittest.TestCase):
+    def setUp(self):
+        self.repository = TestRepository(_db)
+        for a,b in [('a',1),('a',2),('b',1)]:
+            self.repository.add(LazyTestDocumentBuilder(a=a,b=b))
+            
+    def tearDown(self):
+        self.repository.collection().drop()
+        
+    def test_fields_not_mutated(self):
+        fields = ['a']
+        list(self.repository.get_all_with_index(fields=fields))
+        self.assertEquals(['a'], fields)
+        
+    def test_load_on_access(self):
+        docs = list(self.repository.get_all_with_index(fields=['a']))
+        self.assertEquals(3, len(docs))
+        self.assertTrue(docs[0].is_partial())
+        self.assertEquals(set(['a','_id','_cls']), docs[0].loaded_fields())
+        self.assertFalse('b' in docs[0])
+        
+        self.assertEquals(42.0, docs[0]['c'])
+        self.assertFalse(docs[0].is_partial())
+        # documents from the same cursor are loaded together
+        self.assertFalse(docs[2].is_partial())
+        self.assertEquals(docs[2]['b'], docs[2].get('b'))
+        self.assertRaises(KeyError, lambda: docs[1]['nothing'])
+        
+    def test_update_partial(self):
+        doc = list(self.repository.get_all_with_index(fields=['a']).limit(1))[0]
+        doc['a'] = 'z'
+        self.repository.update(doc)
+        
+        saved = self.repository.get_one_by_a('z')
+        self.assertEquals(42.0, saved['c'])
+        self.assertTrue(saved['b'] in (1,2))
+        
+    def test_update_partial_unprojected_field(self):
+        doc = list(self.repository.get_all_with_index(fields=['a']).limit(1))[0]
+        doc['c'] = 1.5
+        self.repository.update(doc)
+        self.assertEquals(1.5, self.repository.collection().find_one({'_id' : doc['_id']})['c'])
+        
+    def test_update_partial_removed(self):
+        doc = list(self.repository.get_all_with_index(fields=['a']).limit(1))[0]
+        self.repository.collection().remove({'_id' : doc['_id']})
+        self.assertRaises(PartialDocumentException, self.repository.update, doc)
+        self.assertEquals(None, self.repository.collection().find_one({'_id' : doc['_id']}))
+        
+    def test_dotted_fields(self):
+        self.repository.collection().update({}, {'$set' : {'d' : {'x' : 1, 'y' : 2}}}, multi=True)
+        doc = list(self.repository.get_all_with_index(fields=['d.x']).limit(1))[0]
+        self.assertFalse('d' in doc.loaded_fields())
+        self.assertEquals(1, doc['d']['x'])
+        self.assertTrue(doc.is_partial())
+        self.assertEquals(2, doc['d']['y'])
+        self.assertFalse(doc.is_partial())
+        
+    def test_changed_list(self):
+        self.repository.collection().update({}, {'$set' : {'l' : [{'x' : 1, 'y' : 2}]}}, multi=True)
+        doc = list(self.repository.get_all_with_index(fields=['l.x']).limit(1))[0]
+        self.repository.collection().update({'_id' : doc['_id']}, {'$push' : {'l' : {'x' : 3, 'y' : 4}}})
+        self.assertRaises(PartialDocumentException, lambda: doc['l'][0]['y'])
+        self.assertTrue(doc['l'][0].is_partial())
+        
+    def test_pickle(self):
+        doc = list(self.repository.get_all_with_index(fields=['a']).limit(1))[0]
+        copied = pickle.loads(pickle.dumps(doc, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(dict(doc), dict(copied))
+        self.assertTrue(copied.is_partial())
+        self.assertEquals(doc.loaded_fields(), copied.loaded_fields())
+        self.assertRaises(PartialDocumentException, lambda: copied['c'])
+        self.assertEquals(42.0, doc['c'])
+        
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.repository = TestRepository(_db)
+        
+    def tearDown(self):
+        self.repository.collection().drop()
+        profiling.reset()
+        
+    def test_profile(self):
+        original = Document.__dict__['__init__']
+        with profiling.profile() as p:
+            self.assertNotEquals(original, Document.__dict__['__init__'])
+            self.repository.add(LazyTestDocumentBuilder(a='a',b=1))
+            self.assertEquals(1,len(list(self.repository.get_all())))
+        self.assertEquals(original, Document.__dict__['__init__'])
+        self.assertFalse(profiling.is_enabled())
+        
+        stats = p.stats
+        self.assertEquals(1,stats[('builder.build','LazyTestDocumentBuilder')].calls)
+        self.assertTrue(('hydration','LazyTestDocument') in stats)
+        self.assertTrue(('manipulator.outgoing','LazyTestDocument') in stats)
+        self.assertTrue('database' in p.by_stage())
+        # profile() alone does not touch the process-wide aggregate
+        self.assertEquals({}, profiling.stats().stats)
+        
+    def test_enable(self):
+        profiling.enable()
+        try:
+            with profiling.profile():
+                pass
+            self.assertTrue(profiling.is_enabled())
+            TestDocumentBuilder(a='a').build()
+        finally:
+            profiling.disable()
+        self.assertEquals(1,profiling.stats().stats[('builder.build','TestDocumentBuilder')].calls)
+        
+    def test_profile_thread(self):
+        profiling.enable()
+        try:
+            with profiling.profile() as p:
+                thread = threading.Thread(target=lambda: TestDocumentBuilder(a='a').build())
+                thread.start()
+                thread.join()
+        finally:
+            profiling.disable()
+        self.assertFalse(('builder.build','TestDocumentBuilder') in p.stats)
+        self.assertEquals(1,profiling.stats().stats[('builder.build','TestDocumentBuilder')].calls)
         
 if __name__ == '__main__':
-	unittest.main()
\ No newline at end of file
+	unittest.main()